@@ -0,0 +1,326 @@
+"""Parsing, breach computation and output helpers for the TAT breach dashboard.
+
+Kept free of Streamlit so app.py reruns don't re-execute it on every interaction.
+"""
+import io
+from functools import lru_cache
+from importlib.util import find_spec
+import xlsxwriter
+import pandas as pd
+import numpy as np
+from pandas.tseries.api import guess_datetime_format
+
+# ------------------ Helpers ---------------------
+BREACH_NOTE_GRACE_MIN = 5  # minutes window for "within 5 mins of breach"
+BREACH_NOTE_GRACE = pd.Timedelta(minutes=BREACH_NOTE_GRACE_MIN)
+DT_SAMPLE_ROWS = 100       # rows sampled to detect a column's timestamp format
+
+@lru_cache(maxsize=4096)
+def normalize(s: str) -> str:
+    # split()/join collapses every whitespace run (newlines, tabs, repeated spaces)
+    # and trims the ends in one pass; header strings repeat, so results are memoized
+    return " ".join(str(s or "").split()).lower()
+
+def guess_format(s: pd.Series):
+    sample = s.dropna().head(DT_SAMPLE_ROWS)
+    fmts = {guess_datetime_format(v) for v in sample.unique() if isinstance(v, str)}
+    fmts.discard(None)
+    return fmts.pop() if len(fmts) == 1 else None
+
+def to_dt(s: pd.Series) -> pd.Series:
+    if s.dtype.kind == "M":
+        return s
+    if s.dtype.kind == "u":
+        s = s.astype("int64")  # uint64 takes a slow object path in to_datetime
+    fmt = guess_format(s)
+    if fmt is None:
+        return pd.to_datetime(s, errors="coerce", format="mixed", cache=True)
+    out = pd.to_datetime(s, errors="coerce", format=fmt, cache=True)
+    # cells that don't follow the sampled format get the per-cell parser, as before
+    miss = out.isna() & s.notna()
+    if miss.any():
+        out[miss] = pd.to_datetime(s[miss], errors="coerce", format="mixed", cache=True)
+    return out
+
+def fmt_time(s: pd.Series) -> pd.Series:
+    return s.dt.strftime("%Y-%m-%d %H:%M").fillna("—")
+
+# ------------------ Stage config ----------------
+STAGE_LABELS = {
+    "created_to_placed": "Created → Placed",
+    "placed_to_accepted": "Placed → Accepted",
+    "accepted_to_in_kitchen": "Order Accepted → Kitchen",
+    "in_kitchen_to_ready": "In Kitchen → Ready",
+    "ready_to_shipped": "Ready → Shipped",
+}
+THRESHOLDS = {
+    "created_to_placed": 5,    # treat "tpl_pending" as "order_placed" by using this stage
+    "placed_to_accepted": 7,
+    "accepted_to_in_kitchen": 5,
+    "in_kitchen_to_ready": 15,
+    "ready_to_shipped": 10,
+}
+STAGE_ORDER = [
+    "created_to_placed",
+    "placed_to_accepted",
+    "accepted_to_in_kitchen",
+    "in_kitchen_to_ready",
+    "ready_to_shipped",
+]
+
+# (start, end) columns per stage. The exports carry no in-kitchen timestamp, so
+# both kitchen stages are measured over accepted -> ready, each against its own
+# threshold; compute_breaches evaluates that shared span only once.
+STAGE_SEGMENTS = {
+    "created_to_placed":      ("createdOn",  "placedAt"),
+    "placed_to_accepted":     ("placedAt",   "acceptedAt"),
+    "accepted_to_in_kitchen": ("acceptedAt", "readyAt"),
+    "in_kitchen_to_ready":    ("acceptedAt", "readyAt"),
+    "ready_to_shipped":       ("readyAt",    "shippedAt"),
+}
+
+# STAGE_ORDER-aligned arrays, so per-stage lookups are array indexing
+STAGE_LABEL_ARRAY = np.array([STAGE_LABELS[k] for k in STAGE_ORDER], dtype=object)
+STAGE_THRESHOLD_MIN = np.array([THRESHOLDS[k] for k in STAGE_ORDER], dtype=np.int64)
+
+def compute_breaches(orders: pd.DataFrame) -> pd.DataFrame:
+    """One row per order: breached_/end_<stage> columns, as join_stage_notes reads them.
+
+    Durations stay timedelta64; all stages are compared to their thresholds in
+    one broadcast over an (orders, stages) matrix.
+    """
+    durations = {}
+    for segment in STAGE_SEGMENTS.values():
+        if segment not in durations:
+            start, end = segment
+            durations[segment] = (orders[end] - orders[start]).clip(lower=pd.Timedelta(0)).to_numpy(dtype="timedelta64[ns]")
+    dur = np.column_stack([durations[STAGE_SEGMENTS[k]] for k in STAGE_ORDER])
+    # NaT compares False, so stages missing either timestamp never breach
+    breached = dur > STAGE_THRESHOLD_MIN.astype("timedelta64[m]")
+
+    columns = {}
+    for i, key in enumerate(STAGE_ORDER):
+        columns[f"breached_{key}"] = breached[:, i]
+        columns[f"end_{key}"] = orders[STAGE_SEGMENTS[key][1]]
+    return pd.DataFrame(columns, index=orders.index)
+
+def join_stage_notes(orders: pd.DataFrame, stages_df: pd.DataFrame, notes: pd.DataFrame) -> pd.DataFrame:
+    """One row per (order, stage with an end time, note), in order/stage/note order.
+
+    Stages without notes keep one row (has_note False); orders with no stage end
+    time get a single placeholder row with stage NaN.
+    """
+    n = len(orders)
+    ids = orders["id"].array  # stays Categorical so the merge below joins on codes
+    parts = []
+    for pos, key in enumerate(STAGE_ORDER):
+        end = stages_df[f"end_{key}"]
+        has_end = end.notna().to_numpy()
+        parts.append(pd.DataFrame({
+            "order_pos": np.arange(n)[has_end],
+            "id": ids[has_end],
+            # five stage keys repeated per row: codes, not strings
+            "stage": pd.Categorical.from_codes(np.full(has_end.sum(), pos, dtype="int8"), categories=STAGE_ORDER),
+            "breach_time": end.to_numpy()[has_end],
+            "breached": stages_df[f"breached_{key}"].to_numpy()[has_end],
+        }))
+    long = pd.concat(parts, ignore_index=True).sort_values("order_pos", kind="stable")
+
+    joined = long.merge(notes, on="id", how="left", indicator="has_note")
+    joined["has_note"] = joined["has_note"].eq("both")
+    delta = joined["noteAt"] - joined["breach_time"]
+    joined["within_grace"] = joined["breached"] & (delta >= pd.Timedelta(0)) & (delta <= BREACH_NOTE_GRACE)
+    joined["after_grace"] = joined["breached"] & (delta > BREACH_NOTE_GRACE)
+
+    no_stage = np.setdiff1d(np.arange(n), long["order_pos"].to_numpy())
+    placeholders = pd.DataFrame({"order_pos": no_stage, "id": ids[no_stage]})
+    return pd.concat([joined, placeholders], ignore_index=True).sort_values("order_pos", kind="stable")
+
+# ------------------ Headers ----------------
+ORDER_ID_ALIASES = [
+    "Network Order Id", "Network Order ID", "Network order id", "order id",
+    "Order ID", "Order No", "Order Number", "Order #", "Order Reference", "Network Ref"
+]
+ORDERS_COL_ALIASES = {
+    "createdOn": ["Created On", "Created", "Created Date", "Created Time"],
+    "placedAt":  ["Order Placed Time", "Placed At", "Order Placed", "Placed Time"],
+    "acceptedAt":["Order Accepted Time", "Accepted At", "Order Accepted", "Accepted Time"],
+    "readyAt":   ["Order Ready Time", "Ready At", "Order Ready", "Ready Time"],
+    "shippedAt": ["Shipped At Date & Time", "Shipped at", "Shipped At", "Shipped Time", "Out For Delivery"],
+}
+NOTES_ID_ALIASES = [
+    "Network order ID", "Network Order Id", "Network Order ID", "Network order id",
+    "Order ID", "Order No", "Order Number", "Order #", "Order Reference", "Network Ref"
+]
+NOTES_COL_ALIASES = {
+    "noteAt": ["Created at", "Note Time", "Created On", "Created"],
+    "description": ["Description", "Notes", "Comment", "Body"],
+    "agent": ["Reported by", "Agent", "Agent Name", "User", "Updated By", "Created By", "Author", "Owner", "Assignee"]
+}
+
+ORDERS_ALIAS_GROUPS = [ORDER_ID_ALIASES, *ORDERS_COL_ALIASES.values()]
+NOTES_ALIAS_GROUPS = [NOTES_ID_ALIASES, *NOTES_COL_ALIASES.values()]
+
+def build_col_map(columns):
+    # normalized header -> actual column name, built once per frame
+    return {normalize(c): c for c in columns}
+
+def resolve(col_map, aliases):
+    for a in aliases:
+        k = col_map.get(normalize(a))
+        if k is not None:
+            return k
+    return None
+
+def column(df: pd.DataFrame, col_map, aliases) -> pd.Series:
+    k = resolve(col_map, aliases)
+    if k is None:
+        return pd.Series(None, index=df.index, dtype=object)
+    return df[k]
+
+def has_any(col_map, aliases):
+    return resolve(col_map, aliases) is not None
+
+def validate_orders_columns(df: pd.DataFrame):
+    col_map = build_col_map(df.columns)
+    miss = []
+    if not has_any(col_map, ORDER_ID_ALIASES):
+        miss.append("any of " + ", ".join(ORDER_ID_ALIASES))
+    for field, aliases in ORDERS_COL_ALIASES.items():
+        if not has_any(col_map, aliases):
+            miss.append(f"any of {aliases} for '{field}'")
+    return miss
+
+def validate_notes_columns(df: pd.DataFrame):
+    col_map = build_col_map(df.columns)
+    miss = []
+    if not has_any(col_map, NOTES_ID_ALIASES):
+        miss.append("any of " + ", ".join(NOTES_ID_ALIASES))
+    if not has_any(col_map, NOTES_COL_ALIASES["noteAt"]):
+        miss.append("any of " + ", ".join(NOTES_COL_ALIASES["noteAt"]))
+    return miss
+
+# normalized alias sets the validators above require, for header-row probing
+# without building a frame per candidate row
+ORDERS_REQUIRED_SETS = [frozenset(map(normalize, g)) for g in ORDERS_ALIAS_GROUPS]
+NOTES_REQUIRED_SETS = [frozenset(map(normalize, g)) for g in (NOTES_ID_ALIASES, NOTES_COL_ALIASES["noteAt"])]
+
+def map_orders(df: pd.DataFrame) -> pd.DataFrame:
+    col_map = build_col_map(df.columns)
+    ids = column(df, col_map, ORDER_ID_ALIASES)
+    keep = ids.notna()
+    out = pd.DataFrame({"id": ids[keep].astype(str).str.strip().astype("category")})
+    for field, aliases in ORDERS_COL_ALIASES.items():
+        out[field] = to_dt(column(df, col_map, aliases)[keep])
+    return out.reset_index(drop=True)
+
+def map_notes(df: pd.DataFrame) -> pd.DataFrame:
+    col_map = build_col_map(df.columns)
+    ids = column(df, col_map, NOTES_ID_ALIASES)
+    keep = ids.notna()
+    out = pd.DataFrame({
+        # ids and agents repeat heavily; categories hash/group on integer codes
+        "id": ids[keep].astype(str).str.strip().astype("category"),
+        "noteAt": to_dt(column(df, col_map, NOTES_COL_ALIASES["noteAt"])[keep]),
+        "description": column(df, col_map, NOTES_COL_ALIASES["description"])[keep].fillna(""),
+        "agent": column(df, col_map, NOTES_COL_ALIASES["agent"])[keep].fillna("").astype(str).str.strip().astype("category"),
+    })
+    return out.reset_index(drop=True)
+
+HEADER_SCAN_ROWS = 31  # rows searched for the header when the preferred one doesn't match
+# python-calamine (Rust) parses xlsx several times faster than openpyxl; fall back
+# to pandas' default engine when it isn't installed
+EXCEL_ENGINE = "calamine" if find_spec("python_calamine") else None
+
+def header_names(row: pd.Series):
+    # same naming read_excel(header=...) uses: blanks -> "Unnamed: i", repeats -> "name.1"
+    names, seen = [], {}
+    for i, v in enumerate(row):
+        name = f"Unnamed: {i}" if pd.isna(v) else v
+        k = seen.get(name, 0)
+        seen[name] = k + 1
+        names.append(f"{name}.{k}" if k else name)
+    return names
+
+def frame_with_header(raw: pd.DataFrame, idx: int, alias_groups=None) -> pd.DataFrame:
+    names = header_names(raw.iloc[idx])
+    keep = range(len(names))
+    if alias_groups is not None:
+        # only the columns the aliases resolve to; wide exports carry dozens more
+        col_map = build_col_map(names)
+        used = {resolve(col_map, aliases) for aliases in alias_groups}
+        keep = [i for i, name in enumerate(names) if name in used]
+    df = raw.iloc[idx + 1:, keep].reset_index(drop=True)
+    df.columns = [names[i] for i in keep]
+    return df.infer_objects()
+
+def read_raw_sheet(file):
+    # calamine first; if it rejects a workbook, retry with pandas' default engine
+    engines = [EXCEL_ENGINE, None] if EXCEL_ENGINE else [None]
+    for engine in engines:
+        try:
+            if hasattr(file, "seek"):
+                file.seek(0)
+            return pd.read_excel(file, sheet_name=0, header=None, dtype=object, engine=engine)
+        except Exception:
+            continue
+    return None
+
+def load_with_header_auto(file, preferred_header_index=None, is_orders=False):
+    # parse the sheet once and try each candidate header row in memory
+    raw = read_raw_sheet(file)
+    if raw is None:
+        return None
+    required = ORDERS_REQUIRED_SETS if is_orders else NOTES_REQUIRED_SETS
+    alias_groups = ORDERS_ALIAS_GROUPS if is_orders else NOTES_ALIAS_GROUPS
+
+    def _matches(idx):
+        if idx >= len(raw):
+            return False
+        cells = {normalize(v) for v in raw.iloc[idx]}
+        return all(not cells.isdisjoint(group) for group in required)
+
+    candidates = [] if preferred_header_index is None else [preferred_header_index]
+    for idx in candidates + list(range(HEADER_SCAN_ROWS)):
+        if _matches(idx):
+            return frame_with_header(raw, idx, alias_groups)
+    fallback = preferred_header_index or 0
+    return frame_with_header(raw, fallback) if fallback < len(raw) else None
+
+# ------------------ Output ----------------------
+def fmt_td_gap(breach_time: pd.Series, note_time: pd.Series) -> pd.Series:
+    # signed mm:ss, whole seconds truncated toward zero; minutes may exceed 99
+    secs = np.trunc((note_time - breach_time).dt.total_seconds())
+    out = pd.Series("—", index=secs.index, dtype=object)
+    ok = secs.notna()
+    v = secs[ok].astype("int64")
+    m, r = divmod(v.abs(), 60)
+    sign = pd.Series(np.where(v < 0, "-", ""), index=v.index)
+    out[ok] = sign + m.astype(str).str.zfill(2) + ":" + r.astype(str).str.zfill(2)
+    return out
+
+def or_dash(s: pd.Series) -> pd.Series:
+    s = s.astype(object)
+    return s.where(s.notna() & s.ne(""), "—").astype(str)
+
+def to_xlsx(df: pd.DataFrame, sheet_name: str) -> io.BytesIO:
+    # constant_memory flushes each row as it is written, keeping RSS flat for big
+    # outputs. It only accepts row-by-row writes and pandas' to_excel writes
+    # column by column, so the rows are streamed here directly.
+    buffer = io.BytesIO()
+    workbook = xlsxwriter.Workbook(buffer, {"constant_memory": True})
+    sheet = workbook.add_worksheet(sheet_name)
+    header = workbook.add_format({"bold": True, "border": 1, "align": "center", "valign": "top"})
+    sheet.write_row(0, 0, list(df.columns), header)
+    for i, row in enumerate(df.itertuples(index=False, name=None), start=1):
+        sheet.write_row(i, 0, row)
+    workbook.close()
+    buffer.seek(0)
+    return buffer
+
+def to_csv_bytes(df: pd.DataFrame) -> bytes:
+    # pandas encodes straight into the binary buffer, skipping the full-size
+    # intermediate str that .to_csv().encode() builds
+    buffer = io.BytesIO()
+    df.to_csv(buffer, index=False, encoding="utf-8")
+    return buffer.getvalue()